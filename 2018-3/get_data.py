@@ -1,13 +1,28 @@
 import concurrent.futures
+import io
 import os
+import shutil
 import zipfile
 
 import requests
 from tqdm import tqdm
 
+from job_state import JobState, TEMP_SUFFIX, check_free_space, format_size, free_space
+
+# Disk usage options
+DELETE_ARCHIVES = False  # delete each zip as soon as it has been extracted
+MAX_WORKERS = 4
+
+# Network options
+TIMEOUT = (10, 60)  # connect and read timeouts (seconds), so a stalled link fails and can be resumed
+
 # Create directories
+raw_dir = 'melanoma_dataset/raw'
 os.makedirs('melanoma_dataset', exist_ok=True)
-os.makedirs('melanoma_dataset/raw', exist_ok=True)
+os.makedirs(raw_dir, exist_ok=True)
+
+# Per-file progress, so an interrupted run resumes where it stopped
+state = JobState('melanoma_dataset/state.db')
 
 # URLs for the dataset
 urls = {
@@ -19,18 +34,151 @@ urls = {
     'validation_gt': 'https://isic-challenge-data.s3.amazonaws.com/2018/ISIC2018_Task3_Validation_GroundTruth.zip',
 }
 
-# Download function with progress bar
-def download_file(name, url):
-    destination = os.path.join('melanoma_dataset/raw', os.path.basename(url))
-    print(f"Downloading {os.path.basename(destination)}...")
+class HTTPRangeFile(io.RawIOBase):
+    """Seekable read-only view of a remote file, fetched with HTTP range requests"""
+
+    def __init__(self, url, size):
+        self.url = url
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        return self.pos
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.pos + size, self.size)
+        if end <= self.pos:
+            return b''
+        response = requests.get(self.url, headers={'Range': f'bytes={self.pos}-{end - 1}'}, timeout=TIMEOUT)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise OSError("Server does not support range requests")
+        data = response.content
+        self.pos += len(data)
+        return data
+
+
+def estimate_sizes(url):
+    """Estimate (download size, extracted size) in bytes from content-length and the zip central directory"""
+    archive = os.path.basename(url)
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=TIMEOUT)
+        response.raise_for_status()
+        archive_size = int(response.headers.get('content-length', 0))
+    except (requests.RequestException, ValueError) as e:
+        print(f"Warning: could not get the size of {archive}: {e}")
+        archive_size = 0
+    if not archive_size:
+        print(f"Warning: size of {archive} is unknown and is not counted in the space check")
+        return 0, 0
+    if not url.endswith('.zip'):
+        return archive_size, 0
+
+    extracted_size = archive_size  # images barely compress, so this is a fair fallback
+    try:
+        with zipfile.ZipFile(HTTPRangeFile(url, archive_size)) as zip_ref:
+            extracted_size = sum(info.file_size for info in zip_ref.infolist())
+    except (OSError, zipfile.BadZipFile, requests.RequestException) as e:
+        print(f"Warning: could not read zip directory of {archive}: {e}")
+    return archive_size, extracted_size
+
+
+def preflight(urls):
+    """Check free space against the estimated peak usage and return the number of workers to use"""
+    print("Checking available disk space...")
+    extracted = state.done('extract_file')
+    sizes = {}
+    for name, url in urls.items():
+        archive = os.path.basename(url)
+        destination = os.path.join(raw_dir, archive)
+        archive_size, extracted_size = estimate_sizes(url)
+
+        # Only count what an earlier run has not already put on disk
+        if state.is_done('download', archive) and os.path.exists(destination):
+            archive_size = 0
+        elif os.path.exists(destination + TEMP_SUFFIX):
+            archive_size = max(archive_size - os.path.getsize(destination + TEMP_SUFFIX), 0)
+        extracted_size -= sum(os.path.getsize(path) for key, path in extracted.items()
+                              if key.startswith(archive + '/') and os.path.isfile(path))
+        extracted_size = max(extracted_size, 0)
+
+        sizes[name] = (archive_size, extracted_size)
+        print(f"  {name}: still to download {format_size(archive_size)}, "
+              f"to extract {format_size(extracted_size)}")
+
+    # With concurrent downloads every archive may be on disk before the first one is deleted
+    concurrent_peak = sum(archive_size + extracted_size for archive_size, extracted_size in sizes.values())
+
+    # Downloading one archive at a time only ever holds a single zip when archives are deleted
+    sequential_peak = concurrent_peak
+    if DELETE_ARCHIVES:
+        zipped = [sizes[name] for name, url in urls.items() if url.endswith('.zip')]
+        sequential_peak -= sum(archive_size for archive_size, _ in zipped)
+        sequential_peak += max((archive_size for archive_size, _ in zipped), default=0)
+
+    free = free_space(raw_dir)
+    print(f"Estimated peak usage: {format_size(concurrent_peak)}, available: {format_size(free)}")
 
-    response = requests.get(url, stream=True)
-    total_size = int(response.headers.get('content-length', 0))
+    if concurrent_peak <= free:
+        return MAX_WORKERS
+    if sequential_peak <= free:
+        print(f"Low on disk space, downloading one file at a time (peak {format_size(sequential_peak)})")
+        return 1
+
+    hint = "" if DELETE_ARCHIVES else " Set DELETE_ARCHIVES = True to remove each zip after extraction."
+    raise SystemExit(f"Not enough disk space: need {format_size(sequential_peak)}, "
+                     f"{format_size(free)} available.{hint}")
+
+
+def final_stage(url):
+    """Last stage a file goes through: zips are extracted, everything else is only downloaded"""
+    return 'extract' if url.endswith('.zip') else 'download'
+
+
+# Download function with progress bar, resuming a partial download when possible
+def fetch(url, destination):
+    temp_path = destination + TEMP_SUFFIX
+    offset = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+    response = requests.get(url, stream=True, headers=headers, timeout=TIMEOUT)
+    if offset and response.status_code == 416:
+        if response.headers.get('content-range') == f'bytes */{offset}':
+            # The previous run finished downloading but stopped before the rename
+            os.replace(temp_path, destination)
+            return
+        # The partial file does not match the remote one, start over
+        os.remove(temp_path)
+        return fetch(url, destination)
+    response.raise_for_status()
+    if offset and response.status_code != 206:
+        print(f"Server ignored the resume request, restarting {os.path.basename(destination)}")
+        offset = 0
+    elif offset:
+        print(f"Resuming {os.path.basename(destination)} from {format_size(offset)}")
+
+    total_size = offset + int(response.headers.get('content-length', 0))
     block_size = 1024
 
-    with open(destination, 'wb') as file, tqdm(
+    with open(temp_path, 'ab' if offset else 'wb') as file, tqdm(
             desc=os.path.basename(destination),
             total=total_size,
+            initial=offset,
             unit='B',
             unit_scale=True,
             unit_divisor=1024,
@@ -38,22 +186,90 @@ def download_file(name, url):
         for data in response.iter_content(block_size):
             bar.update(len(data))
             file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+    if total_size > offset and os.path.getsize(temp_path) != total_size:
+        raise OSError(f"Incomplete download of {os.path.basename(destination)}: "
+                      f"{os.path.getsize(temp_path)} of {total_size} bytes")
+    os.replace(temp_path, destination)
+
+
+def extract(archive_path, extract_dir):
+    """Extract each member through a temp file, skipping members finished by an earlier run"""
+    archive = os.path.basename(archive_path)
+    extracted = state.done('extract_file')
+
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        pending = []
+        for info in zip_ref.infolist():
+            parts = [part for part in info.filename.split('/') if part not in ('', '.', '..')]
+            target = os.path.join(extract_dir, *parts)
+            key = f"{archive}/{info.filename}"
+            if key in extracted and os.path.exists(target):
+                continue
+            pending.append((info, target, key))
+
+        check_free_space(raw_dir, sum(info.file_size for info, _, _ in pending), f"extracting {archive}")
+
+        for info, target, key in tqdm(pending, desc=f"Extracting {archive}"):
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with zip_ref.open(info) as source, open(target + TEMP_SUFFIX, 'wb') as file:
+                shutil.copyfileobj(source, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(target + TEMP_SUFFIX, target)
+            state.mark_done('extract_file', key, target)
+
+
+def download_file(name, url):
+    archive = os.path.basename(url)
+    destination = os.path.join(raw_dir, archive)
+    extract_dir = destination.replace('.zip', '')
+
+    if state.is_done(final_stage(url), archive):
+        print(f"{archive} already done, skipping")
+        # An earlier run may have stopped before deleting the archive
+        if DELETE_ARCHIVES and url.endswith('.zip') and os.path.exists(destination):
+            os.remove(destination)
+            print(f"Deleted {archive}")
+        return name, extract_dir if DELETE_ARCHIVES and url.endswith('.zip') else destination
+
+    if state.is_done('download', archive) and os.path.exists(destination):
+        print(f"{archive} already downloaded")
+    else:
+        print(f"Downloading {archive}...")
+        fetch(url, destination)
+        state.mark_done('download', archive, destination)
 
     # Extract if it's a zip file
     if destination.endswith('.zip'):
-        print(f"Extracting {os.path.basename(destination)}...")
-        with zipfile.ZipFile(destination, 'r') as zip_ref:
-            extract_dir = destination.replace('.zip', '')
-            os.makedirs(extract_dir, exist_ok=True)
-            zip_ref.extractall(extract_dir)
+        print(f"Extracting {archive}...")
+        os.makedirs(extract_dir, exist_ok=True)
+        extract(destination, extract_dir)
+        state.mark_done('extract', archive, extract_dir)
         print(f"Extracted to {extract_dir}")
 
+        # Drop the archive now that its contents are on disk
+        if DELETE_ARCHIVES:
+            os.remove(destination)
+            print(f"Deleted {archive}")
+            destination = extract_dir
+
     return name, destination
 
 
+# Only files that have not finished need space
+pending_urls = {name: url for name, url in urls.items()
+                if not state.is_done(final_stage(url), os.path.basename(url))}
+
 # Download files concurrently
+max_workers = preflight(pending_urls)
 file_paths = {}
-with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
     # Submit all download tasks
     future_to_url = {executor.submit(download_file, name, url): name for name, url in urls.items()}
 
@@ -62,4 +278,5 @@ with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
         name, path = future.result()
         file_paths[name] = path
 
+state.close()
 print("All files downloaded and extracted successfully!")
\ No newline at end of file
@@ -0,0 +1,102 @@
+import errno
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# Suffix for files that are still being written
+TEMP_SUFFIX = '.part'
+
+# Free space to keep in reserve (bytes)
+SPACE_MARGIN = 512 * 1024 * 1024
+
+
+def format_size(num_bytes):
+    """Human readable size in GiB"""
+    return f"{num_bytes / 1024 ** 3:.2f} GiB"
+
+
+def free_space(path):
+    """Bytes available on the filesystem holding path, minus the reserve"""
+    return max(shutil.disk_usage(path).free - SPACE_MARGIN, 0)
+
+
+def check_free_space(path, needed, stage):
+    """Raise if the filesystem holding path has less than needed bytes available"""
+    free = free_space(path)
+    if needed > free:
+        raise OSError(f"Not enough disk space for {stage}: "
+                      f"need {format_size(needed)}, {format_size(free)} available")
+
+
+class JobState:
+    """Durable record of which files have completed each stage, stored in SQLite (WAL mode)"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'stage TEXT NOT NULL, '
+            'key TEXT NOT NULL, '
+            'path TEXT, '
+            'finished_at REAL NOT NULL, '
+            'PRIMARY KEY (stage, key))'
+        )
+
+    def is_done(self, stage, key):
+        """Check whether key has completed stage"""
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM files WHERE stage = ? AND key = ?', (stage, key)).fetchone()
+        return row is not None
+
+    def done(self, stage):
+        """Map of every key that has completed stage to its recorded path"""
+        with self.lock:
+            rows = self.conn.execute('SELECT key, path FROM files WHERE stage = ?', (stage,)).fetchall()
+        return dict(rows)
+
+    def mark_done(self, stage, key, path=None):
+        """Record that key has completed stage, optionally with the path it produced"""
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO files (stage, key, path, finished_at) VALUES (?, ?, ?, ?)',
+                              (stage, key, path, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def atomic_copy(src_path, dst_path):
+    """Copy through a temp file so dst_path is either absent or complete"""
+    temp_path = dst_path + TEMP_SUFFIX
+    shutil.copy2(src_path, temp_path)
+    with open(temp_path, 'r+b') as file:
+        os.fsync(file.fileno())
+    os.replace(temp_path, dst_path)
+
+
+def atomic_move(src_path, dst_path):
+    """Rename within a filesystem, otherwise copy atomically and remove the source"""
+    try:
+        os.replace(src_path, dst_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        atomic_copy(src_path, dst_path)
+        os.remove(src_path)
+
+
+def remove_temp_files(directory):
+    """Delete half-written files left behind by an interrupted run"""
+    removed = 0
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            if file_name.endswith(TEMP_SUFFIX):
+                os.remove(os.path.join(root, file_name))
+                removed += 1
+    if removed:
+        print(f"Removed {removed} incomplete files from {directory}")
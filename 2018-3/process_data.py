@@ -5,6 +5,11 @@ from pathlib import Path
 from tqdm import tqdm
 import glob
 
+from job_state import JobState, atomic_copy, atomic_move, check_free_space, format_size, remove_temp_files
+
+# Disk usage options
+DELETE_EXTRACTED = False  # move images instead of copying and delete each extracted directory once organized
+
 # Define the base directory and class names
 base_dir = 'melanoma_dataset'
 raw_dir = os.path.join(base_dir, 'raw')
@@ -21,6 +26,10 @@ for split in splits:
         os.makedirs(os.path.join(organized_dir, split, class_name), exist_ok=True)
 print("Directory structure created!")
 
+# Per-file progress, so an interrupted run resumes where it stopped
+state = JobState(os.path.join(base_dir, 'state.db'))
+remove_temp_files(organized_dir)
+
 
 def find_csv_file(pattern):
     """Find CSV file using pattern matching"""
@@ -51,6 +60,46 @@ def find_images_dir(pattern):
     return None
 
 
+def preflight(actual_paths):
+    """Refuse to start when the organized copy will not fit on disk"""
+    print("Checking available disk space...")
+    organized = state.done('organize')
+    total_size = 0
+    for split_name, paths in actual_paths.items():
+        with os.scandir(paths['images_dir']) as entries:
+            for entry in entries:
+                # Images placed by an earlier run need no more space
+                key = f"{split_name}/{os.path.splitext(entry.name)[0]}"
+                if entry.is_file() and not (key in organized and os.path.exists(organized[key])):
+                    total_size += entry.stat().st_size
+
+    # Moving within one filesystem is a rename and needs no extra space
+    same_device = all(os.stat(paths['images_dir']).st_dev == os.stat(organized_dir).st_dev
+                      for paths in actual_paths.values())
+    needed = 0 if DELETE_EXTRACTED and same_device else total_size
+
+    print(f"Images to organize: {format_size(total_size)}, extra space needed: {format_size(needed)}")
+    try:
+        check_free_space(organized_dir, needed, "organizing the dataset")
+    except OSError as e:
+        hint = "" if DELETE_EXTRACTED else " Set DELETE_EXTRACTED = True to move images instead of copying them."
+        raise SystemExit(f"{e}.{hint}")
+
+
+def extracted_root(images_dir):
+    """Top-level directory under raw_dir that images_dir was extracted into"""
+    return os.path.join(raw_dir, os.path.relpath(images_dir, raw_dir).split(os.sep)[0])
+
+
+def remove_extracted(extract_dir):
+    """Delete an extracted directory, warning instead of failing"""
+    try:
+        shutil.rmtree(extract_dir)
+        print(f"Deleted {extract_dir}")
+    except OSError as e:
+        print(f"Warning: could not delete {extract_dir}: {e}")
+
+
 def organize_split(split_name, gt_file, images_dir):
     """Organize images for a specific split (train/validation/test)"""
     print(f"\nOrganizing {split_name} data...")
@@ -108,6 +157,9 @@ def organize_split(split_name, gt_file, images_dir):
     print(f"Found {len(available_images)} images")
     print(f"Sample image files: {list(image_mapping.keys())[:5]}")
 
+    # Images placed by an earlier run
+    organized = state.done('organize')
+
     # Process each row in the ground truth
     successful_moves = 0
     failed_moves = 0
@@ -140,8 +192,23 @@ def organize_split(split_name, gt_file, images_dir):
             failed_moves += 1
             continue
 
+        # Skip images an earlier run already placed
+        key = f"{split_name}/{image_base_name}"
+        if key in organized and os.path.exists(organized[key]):
+            successful_moves += 1
+            continue
+
         # Look for the image file
         if image_base_name not in image_mapping:
+            # An interrupted run may have moved it without recording the move
+            class_dir = os.path.join(organized_dir, split_name, image_class)
+            placed = [os.path.join(class_dir, image_base_name + ext) for ext in ('.jpg', '.jpeg', '.png')]
+            placed = [path for path in placed if os.path.exists(path)]
+            if placed:
+                state.mark_done('organize', key, placed[0])
+                successful_moves += 1
+                continue
+
             print(f"Warning: Image file not found for {image_name}")
             failed_moves += 1
             continue
@@ -152,7 +219,11 @@ def organize_split(split_name, gt_file, images_dir):
 
         # Move the image
         try:
-            shutil.copy2(src_path, dst_path)
+            if DELETE_EXTRACTED:
+                atomic_move(src_path, dst_path)
+            else:
+                atomic_copy(src_path, dst_path)
+            state.mark_done('organize', key, dst_path)
             successful_moves += 1
         except Exception as e:
             print(f"Error moving {os.path.basename(src_path)}: {e}")
@@ -178,10 +249,26 @@ splits_info = {
     }
 }
 
+# Totals include splits finished by an earlier run
+total_successful = 0
+total_failed = 0
+
 # Find actual file paths
 print("Searching for ground truth files and image directories...")
 actual_paths = {}
 for split_name, patterns in splits_info.items():
+    if state.is_done('split', split_name):
+        organized_count = sum(1 for key in state.done('organize') if key.startswith(f"{split_name}/"))
+        total_successful += organized_count
+        print(f"{split_name}: already organized ({organized_count} images), skipping")
+
+        # An earlier run may have stopped before removing the raw copy
+        if DELETE_EXTRACTED:
+            for extract_dir in glob.glob(patterns['images_pattern']):
+                if os.path.isdir(extract_dir):
+                    remove_extracted(extract_dir)
+        continue
+
     # Find ground truth file
     gt_file = find_csv_file(patterns['gt_pattern'])
 
@@ -203,14 +290,25 @@ for split_name, patterns in splits_info.items():
         if not images_dir or not os.path.exists(images_dir):
             print(f"  Missing images directory (pattern: {patterns['images_pattern']})")
 
-# Organize each split
-total_successful = 0
-total_failed = 0
+preflight(actual_paths)
 
+# Organize each split
 for split_name, paths in actual_paths.items():
     successful, failed = organize_split(split_name, paths['gt_file'], paths['images_dir'])
     total_successful += successful
     total_failed += failed
+    if failed == 0:
+        state.mark_done('split', split_name)
+
+    # Free the raw copy once every image of the split has been placed
+    if DELETE_EXTRACTED:
+        extract_dir = extracted_root(paths['images_dir'])
+        if failed == 0:
+            remove_extracted(extract_dir)
+        else:
+            print(f"Keeping {extract_dir}: {failed} images were not organized")
+
+state.close()
 
 # Print summary statistics
 print(f"\n{'=' * 50}")